@@ -1,10 +1,52 @@
 """
 Dataset class for a FastTextModel without the fastText dependency.
 """
-from typing import List, Tuple
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 import torch
 import numpy as np
-from tokenizer.tokenizer import NGramTokenizer
+
+
+@dataclass
+class FastTextBatch:
+    """
+    Batch of observations for a FastTextModel.
+
+    Attributes:
+        ids (torch.LongTensor): Padded token indices, (batch_size, max_len).
+        cat (torch.LongTensor): Categorical variables,
+            (batch_size, number of categorical variables).
+        y (torch.LongTensor): Outcomes, (batch_size,).
+        lengths (torch.LongTensor): Number of tokens of each observation.
+    """
+
+    ids: torch.LongTensor
+    cat: torch.LongTensor
+    y: torch.LongTensor
+    lengths: torch.LongTensor
+
+    def __len__(self) -> int:
+        """
+        Returns the number of observations in the batch.
+
+        Returns:
+            int: Batch size.
+        """
+        return len(self.y)
+
+    def pin_memory(self) -> "FastTextBatch":
+        """
+        Pins the batch tensors, called by the Dataloader when
+        `pin_memory=True`.
+
+        Returns:
+            FastTextBatch: Batch in pinned memory.
+        """
+        self.ids = self.ids.pin_memory()
+        self.cat = self.cat.pin_memory()
+        self.y = self.y.pin_memory()
+        self.lengths = self.lengths.pin_memory()
+        return self
 
 
 class FastTextModelDataset(torch.utils.data.Dataset):
@@ -14,25 +56,30 @@ class FastTextModelDataset(torch.utils.data.Dataset):
 
     def __init__(
         self,
-        categorical_variables: List[List[int]],
-        texts: List[str],
-        outputs: List[int],
-        tokenizer: NGramTokenizer,
+        ids: np.ndarray,
+        lengths: np.ndarray,
+        cat_matrix: np.ndarray,
+        y: np.ndarray,
+        padding_idx: int,
     ):
         """
         Constructor for the TorchDataset class.
 
         Args:
-            categorical_variables (List[List[int]]): The elements of this list
-                are the values of each categorical variable across the dataset.
-            text (List[str]): List of text descriptions.
-            y (List[int]): List of outcomes.
-            tokenizer (Tokenizer): Tokenizer.
+            ids (np.ndarray): Matrix of token indices of shape (N, max_len)
+                padded with `padding_idx`, as returned by
+                `NGramTokenizer.tokenize_corpus`.
+            lengths (np.ndarray): Number of tokens of each observation.
+            cat_matrix (np.ndarray): Int64 matrix of categorical variables
+                of shape (N, number of categorical variables).
+            y (np.ndarray): Outcomes.
+            padding_idx (int): Padding index for the text descriptions.
         """
-        self.categorical_variables = categorical_variables
-        self.texts = texts
-        self.outputs = outputs
-        self.tokenizer = tokenizer
+        self.ids = ids
+        self.lengths = lengths
+        self.cat_matrix = cat_matrix
+        self.y = y
+        self.padding_idx = padding_idx
 
     def __len__(self) -> int:
         """
@@ -41,7 +88,7 @@ class FastTextModelDataset(torch.utils.data.Dataset):
         Returns:
             int: Number of observations.
         """
-        return len(self.outputs)
+        return len(self.y)
 
     def __str__(self) -> str:
         """
@@ -52,7 +99,7 @@ class FastTextModelDataset(torch.utils.data.Dataset):
         """
         return f"<FastTextModelDataset(N={len(self)})>"
 
-    def __getitem__(self, index: int) -> List:
+    def __getitem__(self, index: int) -> Tuple[np.ndarray, torch.LongTensor, int]:
         """
         Returns observation for a given index.
 
@@ -60,58 +107,70 @@ class FastTextModelDataset(torch.utils.data.Dataset):
             index (int): Index.
 
         Returns:
-            List[int, str]: Observation with given index.
+            Tuple[np.ndarray, torch.LongTensor, int]: Token indices,
+                categorical variables and outcome of the observation with
+                given index.
         """
-        categorical_variables = [
-            variable[index] for variable in self.categorical_variables
-        ]
-        text = self.texts[index]
-        y = self.outputs[index]
-        return [text, *categorical_variables, y]
+        return (
+            self.ids[index, : self.lengths[index]],
+            torch.from_numpy(self.cat_matrix[index]),
+            self.y[index],
+        )
+
+    def __getitems__(self, indices: List[int]) -> FastTextBatch:
+        """
+        Returns the batch of observations for given indices, called by
+        the Dataloader instead of `__getitem__` for each index.
+
+        Since `ids` is already padded, the batch is sliced from the
+        arrays at once rather than padded observation by observation.
 
-    def collate_fn(self, batch) -> Tuple[torch.LongTensor]:
+        Args:
+            indices (List[int]): Indices.
+
+        Returns:
+            FastTextBatch: Observations with given indices.
+        """
+        indices = np.asarray(indices)
+        lengths = self.lengths[indices]
+        ids = self.ids[indices, : lengths.max(initial=0)]
+
+        return FastTextBatch(
+            ids=torch.from_numpy(ids.astype(np.int64)),
+            cat=torch.from_numpy(self.cat_matrix[indices]),
+            y=torch.from_numpy(self.y[indices]),
+            lengths=torch.from_numpy(lengths.astype(np.int64)),
+        )
+
+    def collate_fn(self, batch: List) -> FastTextBatch:
         """
         Processing on a batch.
 
         Args:
-            batch: Data batch.
+            batch: Data batch, either a list of observations or a
+                `FastTextBatch` returned by `__getitems__`.
 
         Returns:
-            Tuple[torch.LongTensor]: Observation with given index.
-        """
-        # Get inputs
-        batch = np.array(batch)
-        text = batch[:, 0].tolist()
-        categorical_variables = [
-            batch[:, 1 + i] for i in range(len(self.categorical_variables))
-        ]
-        y = batch[:, -1]
-
-        indices_batch = [self.tokenizer.indices_matrix(sentence)[0] for sentence in text]
-        max_tokens = max([len(indices) for indices in indices_batch])
-
-
-        padding_index = self.tokenizer.get_buckets() + self.tokenizer.get_nwords()
-        padded_batch = [
-            np.pad(
-                indices,
-                (0, max_tokens - len(indices)),
-                "constant",
-                constant_values=padding_index,
-            )
-            for indices in indices_batch
-        ]
-        padded_batch = np.stack(padded_batch)
-
-        # Cast
-        x = torch.LongTensor(padded_batch.astype(np.int32))
-        categorical_tensors = [
-            torch.LongTensor(variable.astype(np.int32))
-            for variable in categorical_variables
-        ]
-        y = torch.LongTensor(y.astype(np.int32))
-
-        return (x, *categorical_tensors, y)
+            FastTextBatch: Padded token indices, categorical variables
+                and outcomes.
+        """
+        if isinstance(batch, FastTextBatch):
+            return batch
+
+        lengths = torch.tensor([len(sample[0]) for sample in batch], dtype=torch.long)
+
+        ids = torch.full(
+            (len(batch), int(lengths.max())), self.padding_idx, dtype=torch.long
+        )
+        for i, (indices, _, _) in enumerate(batch):
+            ids[i, : len(indices)] = torch.from_numpy(indices)
+
+        return FastTextBatch(
+            ids=ids,
+            cat=torch.stack([sample[1] for sample in batch]),
+            y=torch.tensor([sample[2] for sample in batch], dtype=torch.long),
+            lengths=lengths,
+        )
 
     def create_dataloader(
         self,
@@ -119,6 +178,10 @@ class FastTextModelDataset(torch.utils.data.Dataset):
         shuffle: bool = False,
         drop_last: bool = False,
         num_workers: int = 0,
+        pin_memory: bool = True,
+        persistent_workers: bool = False,
+        prefetch_factor: Optional[int] = None,
+        **kwargs,
     ) -> torch.utils.data.DataLoader:
         """
         Creates a Dataloader.
@@ -127,6 +190,15 @@ class FastTextModelDataset(torch.utils.data.Dataset):
             batch_size (int): Batch size.
             shuffle (bool, optional): Shuffle option. Defaults to False.
             drop_last (bool, optional): Drop last option. Defaults to False.
+            num_workers (int, optional): Number of worker processes.
+                Defaults to 0.
+            pin_memory (bool, optional): Pin memory option. Defaults to True.
+            persistent_workers (bool, optional): Keep workers alive between
+                epochs. Ignored when `num_workers` is 0. Defaults to False.
+            prefetch_factor (Optional[int], optional): Number of batches
+                loaded in advance by each worker. Ignored when `num_workers`
+                is 0. Defaults to None.
+            **kwargs: Additional arguments passed to the Dataloader.
 
         Returns:
             torch.utils.data.DataLoader: Dataloader.
@@ -137,6 +209,9 @@ class FastTextModelDataset(torch.utils.data.Dataset):
             collate_fn=self.collate_fn,
             shuffle=shuffle,
             drop_last=drop_last,
-            pin_memory=True,
+            pin_memory=pin_memory,
             num_workers=num_workers,
+            persistent_workers=persistent_workers and num_workers > 0,
+            prefetch_factor=prefetch_factor if num_workers > 0 else None,
+            **kwargs,
         )
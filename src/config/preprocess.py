@@ -2,7 +2,11 @@
 Processing fns.
 """
 import string
+from functools import lru_cache
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import unidecode
 from nltk.corpus import stopwords as ntlk_stopwords
 from nltk.stem.snowball import SnowballStemmer
@@ -22,37 +26,60 @@ def clean_text_feature(
         df (pd.DataFrame): DataFrame.
     """
     # Define stopwords and stemmer
-    stopwords = tuple(ntlk_stopwords.words("french")) + tuple(string.ascii_lowercase)
-    stemmer = SnowballStemmer(language="french")
+    stopwords = frozenset(ntlk_stopwords.words("french")) | frozenset(string.ascii_lowercase)
+    stem = lru_cache(maxsize=None)(SnowballStemmer(language="french").stem)
 
     # Remove of accented characters
-    df[text_feature] = df[text_feature].map(unidecode.unidecode)
+    texts = pa.array(df[text_feature].map(unidecode.unidecode), type=pa.string())
 
-    # To lowercase
-    df[text_feature] = df[text_feature].str.lower()
+    # To lowercase and split into words
+    libs_token = pc.utf8_split_whitespace(pc.utf8_lower(texts)).to_pylist()
 
-    # Remove one letter words
-    df[text_feature] = df[text_feature].apply(
-        lambda x: " ".join([w for w in x.split() if len(w) > 1])
-    )
-
-    # Remove duplicate words and stopwords in texts
+    # Remove one letter words, duplicate words and stopwords in texts
     # Stem words
-    libs_token = [lib.split() for lib in df[text_feature].to_list()]
-    libs_token = [
-        sorted(set(libs_token[i]), key=libs_token[i].index)
-        for i in range(len(libs_token))
-    ]
     df[text_feature] = [
         " ".join(
             [
-                stemmer.stem(word)
-                for word in libs_token[i]
-                if word not in stopwords
+                stem(word)
+                for word in dict.fromkeys(words)
+                if len(word) > 1 and word not in stopwords
             ]
         )
-        for i in range(len(libs_token))
+        for words in libs_token
     ]
 
     # Return clean DataFrame
     return df
+
+
+class CategoryEncoder:
+    """
+    Label encoder relying on `pd.Categorical`, with the interface of
+    `sklearn.preprocessing.LabelEncoder` used in this project.
+    """
+
+    def fit_transform(self, y: pd.Series) -> np.ndarray:
+        """
+        Fits the encoder and encodes labels.
+
+        Args:
+            y (pd.Series): Labels.
+
+        Returns:
+            np.ndarray: Encoded labels.
+        """
+        categorical = y.astype("category")
+        self.classes_ = categorical.cat.categories.to_numpy()
+        return categorical.cat.codes.to_numpy(np.int64)
+
+    def inverse_transform(self, y: np.ndarray) -> np.ndarray:
+        """
+        Transforms encoded labels back to original labels.
+
+        Args:
+            y (np.ndarray): Encoded labels.
+
+        Returns:
+            np.ndarray: Original labels.
+        """
+        return self.classes_[np.asarray(y)]
@@ -2,6 +2,7 @@
 FastText model implemented with Pytorch.
 Integrates additional categorical features.
 """
+from dataclasses import fields
 from typing import List
 import torch
 import torch.nn.functional as F
@@ -13,6 +14,7 @@ import pytorch_lightning as pl
 from scipy.special import softmax
 from captum.attr import IntegratedGradients, LayerIntegratedGradients
 
+from config.dataset import FastTextBatch
 from config.preprocess import clean_text_feature
 from explainability.utils import match_token_to_word, tokenized_text_in_tokens, \
                                  map_processed_to_original, compute_preprocessed_word_score
@@ -81,20 +83,60 @@ class FastTextModel(nn.Module):
             torch.Tensor: Model output.
         """
         # Embed tokens
+        x_1 = self.average_token_embeddings(encoded_text) # (batch_size, embedding_dim)
 
+        return self.classify(x_1, additional_inputs)
+
+    @torch.compiler.disable
+    def average_token_embeddings(self, encoded_text) -> torch.Tensor:
+        """
+        Averages the embeddings of each sequence, padding excluded,
+        without materializing the (batch_size, seq_len, embedding_dim)
+        tensor.
+
+        Left out of `torch.compile` graphs: Inductor cannot lower the
+        sparse embedding_bag backward, and eager mode keeps the compiled
+        part free of the varying sequence length.
+
+        Args:
+            encoded_text (torch.LongTensor): Token indices.
+
+        Returns:
+            torch.Tensor: Text embedding, (batch_size, embedding_dim).
+        """
         x_1 = encoded_text # text list, of length batch_size
 
         if x_1.dtype != torch.long:
             x_1 = x_1.long()
 
+        return F.embedding_bag(
+            x_1,
+            self.embeddings.weight,
+            mode="mean",
+            sparse=self.embeddings.sparse,
+            padding_idx=self.padding_idx,
+        )
 
-        x_1 = self.embeddings(x_1) # (batch_size, seq_len, embedding_dim)
+    def forward_token_embeddings(self, encoded_text, additional_inputs) -> torch.Tensor:
+        """
+        Forward method going through the token embedding layer, so that
+        Captum can attribute the output to each token.
 
-        x_cat = []
-        for i, (variable, embedding_layer) in enumerate(
-            self.categorical_embeddings.items()
-        ):
-            x_cat.append(embedding_layer(additional_inputs[i].long()).squeeze())
+        Args:
+            inputs (List[torch.LongTensor]): Model inputs.
+
+        Returns:
+            torch.Tensor: Model output.
+        """
+        # Embed tokens
+
+        x_1 = encoded_text # text list, of length batch_size
+
+        if x_1.dtype != torch.long:
+            x_1 = x_1.long()
+
+
+        x_1 = self.embeddings(x_1) # (batch_size, seq_len, embedding_dim)
 
         # Aggregating the embeddings of each sequence 
         non_zero_tokens = x_1.sum(-1) != 0
@@ -102,7 +144,27 @@ class FastTextModel(nn.Module):
         x_1 = x_1.sum(dim=-2)
         x_1 /= non_zero_tokens.unsqueeze(-1)
         x_1 = torch.nan_to_num(x_1) # (batch_size, embedding_dim)
-        
+
+        return self.classify(x_1, additional_inputs)
+
+    def classify(self, x_1, additional_inputs) -> torch.Tensor:
+        """
+        Adds the categorical embeddings to the text embedding and
+        applies the linear layer.
+
+        Args:
+            x_1 (torch.Tensor): Text embedding, (batch_size, embedding_dim).
+            additional_inputs (torch.LongTensor): Categorical variables.
+
+        Returns:
+            torch.Tensor: Model output.
+        """
+        x_cat = []
+        for i, (variable, embedding_layer) in enumerate(
+            self.categorical_embeddings.items()
+        ):
+            x_cat.append(embedding_layer(additional_inputs[:, i].long()))
+
         # sum over all the categorical variables, output shape is (batch_size, embedding_dim)
         x_in = x_1 + torch.stack(x_cat, dim=0).sum(dim=0) 
         
@@ -125,7 +187,7 @@ class FastTextModel(nn.Module):
         """
 
         if explain:
-            lig = LayerIntegratedGradients(self, self.embeddings) # initialize a Captum layer gradient integrator
+            lig = LayerIntegratedGradients(self.forward_token_embeddings, self.embeddings) # initialize a Captum layer gradient integrator
 
         self.eval()
         batch_size = len(text)
@@ -166,7 +228,7 @@ class FastTextModel(nn.Module):
             if key != "text":
                 other_features.append(torch.LongTensor(params[key]).reshape(batch_size, -1))
         
-        other_features = torch.stack(other_features).reshape(batch_size, -1).long()
+        other_features = torch.cat(other_features, dim=1).long()
 
         pred = self(x, other_features)
         label_scores = pred.detach().cpu().numpy()
@@ -316,7 +378,7 @@ class FastTextAttention(nn.Module):
         for i, (variable, embedding_layer) in enumerate(
             self.categorical_embeddings.items()
         ):
-            x_cat.append(embedding_layer(additional_inputs[i].long()).squeeze())
+            x_cat.append(embedding_layer(additional_inputs[:, i].long()))
 
         # Aggregating the embeddings of each sequence 
         # non_zero_tokens = x_1.sum(-1) != 0
@@ -386,7 +448,7 @@ class FastTextAttention(nn.Module):
             if key != "text":
                 other_features.append(torch.LongTensor(params[key]).reshape(batch_size, -1))
         
-        other_features = torch.stack(other_features).reshape(batch_size, -1).long()
+        other_features = torch.cat(other_features, dim=1).long()
 
         pred = self(x, other_features)
         label_scores = pred.detach().cpu().numpy()
@@ -419,6 +481,10 @@ class FastTextModule(pl.LightningModule):
         """
         Initialize FastTextModule.
 
+        If the text embedding layer of the model is sparse, its weights
+        are optimized with `torch.optim.SparseAdam` and `optimizer` is only
+        used for the remaining (dense) parameters.
+
         Args:
             model: Model.
             loss: Loss
@@ -441,86 +507,157 @@ class FastTextModule(pl.LightningModule):
         self.scheduler = scheduler
         self.scheduler_params = scheduler_params
         self.scheduler_interval = scheduler_interval
+        # Sparse and dense parameters are stepped by distinct optimizers
+        self.automatic_optimization = False
 
-    def forward(self, inputs: List[torch.LongTensor]) -> torch.Tensor:
+    def forward(self, batch: FastTextBatch) -> torch.Tensor:
         """
         Perform forward-pass.
 
         Args:
-            batch (List[torch.LongTensor]): Batch to perform forward-pass on.
+            batch (FastTextBatch): Batch to perform forward-pass on.
 
         Returns (torch.Tensor): Prediction.
         """
-        return self.model(inputs[0], inputs[1])
+        return self.model(batch.ids, batch.cat)
+
+    def transfer_batch_to_device(
+        self, batch: FastTextBatch, device: torch.device, dataloader_idx: int
+    ) -> FastTextBatch:
+        """
+        Move a batch to the device. Copies are non-blocking so that they
+        overlap with computation when the batch is in pinned memory.
+
+        Args:
+            batch (FastTextBatch): Batch.
+            device (torch.device): Target device.
+            dataloader_idx (int): Dataloader index.
+
+        Returns (FastTextBatch): Batch on the device.
+        """
+        if not isinstance(batch, FastTextBatch):
+            return super().transfer_batch_to_device(batch, device, dataloader_idx)
+        return FastTextBatch(
+            **{
+                field.name: getattr(batch, field.name).to(device, non_blocking=True)
+                for field in fields(batch)
+            }
+        )
 
     def training_step(
-        self, batch: List[torch.LongTensor], batch_idx: int
+        self, batch: FastTextBatch, batch_idx: int
     ) -> torch.Tensor:
         """
         Training step.
 
         Args:
-            batch (List[torch.LongTensor]): Training batch.
+            batch (FastTextBatch): Training batch.
             batch_idx (int): Batch index.
 
         Returns (torch.Tensor): Loss tensor.
         """
-        inputs, targets = batch[:-1], batch[-1]
-        outputs = self.forward(inputs)
-        loss = self.loss(outputs, targets)
-        self.log("train_loss", loss, on_epoch=True)
+        outputs = self.forward(batch)
+        loss = self.loss(outputs, batch.y)
+        self.log("train_loss", loss, on_epoch=True, batch_size=len(batch))
+
+        optimizers = self.optimizers()
+        if not isinstance(optimizers, list):
+            optimizers = [optimizers]
+        for optimizer in optimizers:
+            optimizer.zero_grad()
+        self.manual_backward(loss)
+        for optimizer in optimizers:
+            optimizer.step()
+
+        if self.scheduler_interval == "step":
+            self._step_schedulers()
 
         return loss
 
-    def validation_step(self, batch: List[torch.LongTensor], batch_idx: int):
+    def on_train_epoch_end(self):
+        """
+        Step the schedulers at the end of each epoch.
+        """
+        if self.scheduler_interval == "epoch":
+            self._step_schedulers()
+
+    def _step_schedulers(self):
+        """
+        Step the schedulers, feeding the validation loss to those
+        which monitor it.
+        """
+        schedulers = self.lr_schedulers()
+        if schedulers is None:
+            return
+        if not isinstance(schedulers, list):
+            schedulers = [schedulers]
+
+        validation_loss = self.trainer.callback_metrics.get("validation_loss")
+        for scheduler in schedulers:
+            if isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+                if validation_loss is not None:
+                    scheduler.step(validation_loss)
+            else:
+                scheduler.step()
+
+    def validation_step(self, batch: FastTextBatch, batch_idx: int):
         """
         Validation step.
 
         Args:
-            batch (List[torch.LongTensor]): Validation batch.
+            batch (FastTextBatch): Validation batch.
             batch_idx (int): Batch index.
 
         Returns (torch.Tensor): Loss tensor.
         """
-        inputs, targets = batch[:-1], batch[-1]
-        outputs = self.forward(inputs)
-        loss = self.loss(outputs, targets)
-        self.log("validation_loss", loss, on_epoch=True)
+        outputs = self.forward(batch)
+        loss = self.loss(outputs, batch.y)
+        self.log("validation_loss", loss, on_epoch=True, batch_size=len(batch))
 
-        accuracy = self.accuracy_fn(outputs, targets)
-        self.log('validation_accuracy', accuracy, on_epoch=True)
+        accuracy = self.accuracy_fn(outputs, batch.y)
+        self.log('validation_accuracy', accuracy, on_epoch=True, batch_size=len(batch))
         return loss
 
-    def test_step(self, batch: List[torch.LongTensor], batch_idx: int):
+    def test_step(self, batch: FastTextBatch, batch_idx: int):
         """
         Test step.
 
         Args:
-            batch (List[torch.LongTensor]): Test batch.
+            batch (FastTextBatch): Test batch.
             batch_idx (int): Batch index.
 
         Returns (torch.Tensor): Loss tensor.
         """
-        inputs, targets = batch[:-1], batch[-1]
-        outputs = self.forward(inputs)
-        loss = self.loss(outputs, targets)
-        self.log("test_loss", loss, on_epoch=True)
+        outputs = self.forward(batch)
+        loss = self.loss(outputs, batch.y)
+        self.log("test_loss", loss, on_epoch=True, batch_size=len(batch))
 
         return loss
 
     def configure_optimizers(self):
         """
-        Configure optimizer for Pytorch lighting.
+        Configure optimizers for Pytorch lighting.
 
-        Returns: Optimizer and scheduler for pytorch lighting.
+        Returns: Optimizers and schedulers for pytorch lighting.
         """
-        optimizer = self.optimizer(self.parameters(), **self.optimizer_params)
-        scheduler = self.scheduler(optimizer, **self.scheduler_params)
-        scheduler = {
-            "scheduler": scheduler,
-            "monitor": "validation_loss",
-            "interval": self.scheduler_interval,
-        }
+        if self.model.embeddings.sparse:
+            dense_params = [
+                param
+                for name, param in self.model.named_parameters()
+                if not name.startswith("embeddings.")
+            ]
+            optimizers = [
+                torch.optim.SparseAdam(
+                    [self.model.embeddings.weight], **self.optimizer_params
+                ),
+                self.optimizer(dense_params, **self.optimizer_params),
+            ]
+        else:
+            optimizers = [self.optimizer(self.parameters(), **self.optimizer_params)]
+        schedulers = [
+            self.scheduler(optimizer, **self.scheduler_params)
+            for optimizer in optimizers
+        ]
 
-        return [optimizer], [scheduler]
+        return optimizers, schedulers
 
@@ -3,7 +3,12 @@ NGramTokenizer class.
 """
 import numpy as np
 from typing import List, Tuple
-from tokenizer.utils import get_hash, get_word_ngram_id
+from tokenizer.utils import (
+    get_hash,
+    get_word_ngram_id,
+    _sentence_indices,
+    _subword_indices,
+)
 
 
 class NGramTokenizer:
@@ -188,3 +193,93 @@ class NGramTokenizer:
         id_to_token = {v:k for k, v in all_tokens_id.items()}
  
         return np.asarray(all_indices), id_to_token, all_tokens_id
+
+    def tokenize_corpus(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Tokenizes a whole corpus once into a padded matrix of token indices.
+
+        Args:
+            texts (List[str]): List of text descriptions.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Matrix of token indices of shape
+                (len(texts), max_len), padded with the padding index, and
+                the number of tokens of each text.
+        """
+        if len(texts) == 0:
+            return np.zeros((0, 0), dtype=np.int32), np.zeros(0, dtype=np.int32)
+
+        # Map each sentence to the ids of its distinct words, the end of
+        # string token being -1
+        word_index = {}
+        sentence_words = []
+        sentence_offsets = [0]
+        for sentence in texts:
+            sentence_words.extend(
+                [word_index.setdefault(word, len(word_index)) for word in sentence.split(" ")]
+            )
+            sentence_words.append(-1)
+            sentence_offsets.append(len(sentence_words))
+        sentence_words = np.asarray(sentence_words, dtype=np.int64)
+        sentence_offsets = np.asarray(sentence_offsets, dtype=np.int64)
+
+        words = list(word_index)
+        word_lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+        word_offsets = np.concatenate(([0], np.cumsum(word_lengths)))
+        codepoints = np.frombuffer(
+            "".join(words).encode("utf-32-le", errors="surrogatepass"), dtype=np.int32
+        )
+        # A word is not added to its tokens when it is one of its n-grams
+        word_ids = np.fromiter(
+            (
+                -1 if self.min_n <= len(word) <= self.max_n
+                else self.word_id_mapping.get(word, -1)
+                for word in words
+            ),
+            dtype=np.int64,
+            count=len(words),
+        )
+
+        # Number of tokens of each word and of each sentence
+        token_counts = (word_ids >= 0) + sum(
+            np.maximum(word_lengths + 3 - n, 0) for n in range(self.min_n, self.max_n + 1)
+        )
+        token_offsets = np.concatenate(([0], np.cumsum(token_counts)))
+        sentence_token_counts = np.where(
+            sentence_words >= 0, token_counts[sentence_words], 1
+        )
+        sentence_lengths = np.diff(sentence_offsets)
+        lengths = np.add.reduceat(sentence_token_counts, sentence_offsets[:-1])
+        lengths += sum(
+            np.maximum(sentence_lengths - n + 1, 0) for n in range(2, self.word_ngrams + 1)
+        )
+
+        subword_indices = np.empty(token_offsets[-1], dtype=np.int32)
+        _subword_indices(
+            codepoints,
+            word_offsets,
+            word_ids,
+            token_offsets,
+            self.min_n,
+            self.max_n,
+            self.buckets,
+            self.nwords,
+            subword_indices,
+        )
+
+        padding_index = self.get_buckets() + self.get_nwords()
+        ids = np.full((len(texts), lengths.max(initial=0)), padding_index, dtype=np.int32)
+        _sentence_indices(
+            codepoints,
+            word_offsets,
+            subword_indices,
+            token_offsets,
+            sentence_words,
+            sentence_offsets,
+            self.word_ngrams,
+            self.buckets,
+            self.nwords,
+            ids,
+        )
+
+        return ids, lengths.astype(np.int32)
@@ -1,6 +1,9 @@
-import ctypes
 from typing import Tuple
 import numpy as np
+from numba import config, njit, prange
+
+# The TBB threading layer hangs at exit once Dataloader workers are forked
+config.THREADING_LAYER = "workqueue"
 
 
 def get_hash(subword: str) -> int:
@@ -13,11 +16,13 @@ def get_hash(subword: str) -> int:
     Returns:
         int: Corresponding hash.
     """
-    h = ctypes.c_uint32(2166136261).value
+    h = 2166136261
     for c in subword:
-        c = ctypes.c_int8(ord(c)).value
-        h = ctypes.c_uint32(h ^ c).value
-        h = ctypes.c_uint32(h * 16777619).value
+        # Characters are truncated to signed 8-bit integers, as in fastText
+        c = ord(c) & 0xFF
+        if c & 0x80:
+            c |= 0xFFFFFF00
+        h = ((h ^ c) * 16777619) & 0xFFFFFFFF
     return h
 
 
@@ -33,9 +38,168 @@ def get_word_ngram_id(hashes: Tuple[int], bucket: int, nwords: int) -> int:
     Returns:
         int: Word ngram hash.
     """
-    hashes = [ctypes.c_int32(hash_value).value for hash_value in hashes]
-    h = ctypes.c_uint64(hashes[0]).value
+    # Hashes are read as signed 32-bit integers, then sign-extended to 64 bits
+    hashes = [
+        hash_value | 0xFFFFFFFF00000000 if hash_value & 0x80000000 else hash_value
+        for hash_value in hashes
+    ]
+    h = hashes[0]
     for j in range(1, len(hashes)):
-        h = ctypes.c_uint64((h * 116049371)).value
-        h = ctypes.c_uint64(h + hashes[j]).value
+        h = (h * 116049371 + hashes[j]) & 0xFFFFFFFFFFFFFFFF
     return h % bucket + nwords
+
+
+
+# Code points of the end of string token "</s>"
+EOS_CODEPOINTS = np.array([60, 47, 115, 62], dtype=np.int32)
+
+
+@njit(cache=True)
+def _fnv_update(h: int, codepoint: int) -> int:
+    """
+    Update a FNV-1a hash with one character, as done in `get_hash`.
+
+    Args:
+        h (int): Current hash.
+        codepoint (int): Unicode code point of the character.
+
+    Returns:
+        int: Updated hash.
+    """
+    c = codepoint & 0xFF
+    if c >= 128:
+        c -= 256
+    h = (h ^ (c & 0xFFFFFFFF)) & 0xFFFFFFFF
+    return (h * 16777619) & 0xFFFFFFFF
+
+
+@njit(cache=True)
+def _word_ngram_update(h: np.uint64, codepoint: int) -> np.uint64:
+    """
+    Update a word n-gram hash with the hash of one character, as done
+    in `get_word_ngram_id`.
+
+    Args:
+        h (np.uint64): Current hash.
+        codepoint (int): Unicode code point of the character.
+
+    Returns:
+        np.uint64: Updated hash.
+    """
+    char_hash = _fnv_update(2166136261, codepoint)
+    if char_hash >= 2147483648:
+        char_hash -= 4294967296
+    return h * np.uint64(116049371) + np.uint64(char_hash)
+
+
+@njit(parallel=True, cache=True)
+def _subword_indices(
+    codepoints: np.ndarray,
+    word_offsets: np.ndarray,
+    word_ids: np.ndarray,
+    token_offsets: np.ndarray,
+    min_n: int,
+    max_n: int,
+    buckets: int,
+    nwords: int,
+    out: np.ndarray,
+):
+    """
+    Compute the tokens indices of each distinct word of a corpus,
+    as `NGramTokenizer.get_subwords` does.
+
+    Args:
+        codepoints (np.ndarray): Concatenated code points of the words.
+        word_offsets (np.ndarray): Offsets of the words in `codepoints`.
+        word_ids (np.ndarray): Word indices, -1 when the word itself is
+            not one of its tokens.
+        token_offsets (np.ndarray): Offsets of the tokens of each word
+            in `out`.
+        min_n (int): Minimum length of character n-grams.
+        max_n (int): Maximum length of character n-grams.
+        buckets (int): Number of rows in the embedding matrix.
+        nwords (int): Number of words in the vocabulary.
+        out (np.ndarray): Output token indices.
+    """
+    for w in prange(len(word_ids)):
+        start = word_offsets[w]
+        tagged_length = word_offsets[w + 1] - start + 2
+        pos = token_offsets[w]
+        if word_ids[w] >= 0:
+            out[pos] = word_ids[w]
+            pos += 1
+        for n in range(min_n, max_n + 1):
+            for i in range(tagged_length - n + 1):
+                h = 2166136261
+                for j in range(i, i + n):
+                    if j == 0:
+                        h = _fnv_update(h, 60)  # "<"
+                    elif j == tagged_length - 1:
+                        h = _fnv_update(h, 62)  # ">"
+                    else:
+                        h = _fnv_update(h, codepoints[start + j - 1])
+                out[pos] = h % buckets + nwords
+                pos += 1
+
+
+@njit(parallel=True, cache=True)
+def _sentence_indices(
+    codepoints: np.ndarray,
+    word_offsets: np.ndarray,
+    subword_indices: np.ndarray,
+    token_offsets: np.ndarray,
+    sentence_words: np.ndarray,
+    sentence_offsets: np.ndarray,
+    word_ngrams: int,
+    buckets: int,
+    nwords: int,
+    out_ids: np.ndarray,
+):
+    """
+    Fill the token indices of each sentence of a corpus, as
+    `NGramTokenizer.indices_matrix` does: tokens of each word, end of
+    string token and word n-grams.
+
+    Args:
+        codepoints (np.ndarray): Concatenated code points of the words.
+        word_offsets (np.ndarray): Offsets of the words in `codepoints`.
+        subword_indices (np.ndarray): Output of `_subword_indices`.
+        token_offsets (np.ndarray): Offsets of the tokens of each word
+            in `subword_indices`.
+        sentence_words (np.ndarray): Concatenated word ids of the
+            sentences, each sentence ending with -1 for "</s>".
+        sentence_offsets (np.ndarray): Offsets of the sentences in
+            `sentence_words`.
+        word_ngrams (int): Maximum length of word n-grams.
+        buckets (int): Number of rows in the embedding matrix.
+        nwords (int): Number of words in the vocabulary.
+        out_ids (np.ndarray): Output matrix of token indices.
+    """
+    for s in prange(len(sentence_offsets) - 1):
+        first, last = sentence_offsets[s], sentence_offsets[s + 1]
+        pos = 0
+        for k in range(first, last - 1):
+            w = sentence_words[k]
+            for t in range(token_offsets[w], token_offsets[w + 1]):
+                out_ids[s, pos] = subword_indices[t]
+                pos += 1
+        # End of string token
+        out_ids[s, pos] = 0
+        pos += 1
+
+        # Word n-grams, hashed character by character
+        for ngram_len in range(2, word_ngrams + 1):
+            for i in range(first, last - ngram_len + 1):
+                h = np.uint64(0)
+                for k in range(i, i + ngram_len):
+                    if k > i:
+                        h = _word_ngram_update(h, 32)  # " "
+                    w = sentence_words[k]
+                    if w < 0:
+                        for c in EOS_CODEPOINTS:
+                            h = _word_ngram_update(h, c)
+                    else:
+                        for j in range(word_offsets[w], word_offsets[w + 1]):
+                            h = _word_ngram_update(h, codepoints[j])
+                out_ids[s, pos] = np.int64(h % np.uint64(buckets)) + nwords
+                pos += 1
@@ -1,20 +1,22 @@
 """
 Train the fastText model implemented with Pytorch.
 """
+import hashlib
+import os
+import pickle
 import sys
-import s3fs
-from typing import List, Optional, Dict
+from pathlib import Path
+from typing import List, Optional, Dict, Tuple
 import pytorch_lightning as pl
 import torch
 from torch import nn
-from torch.optim import Adam, SGD
+from torch.optim import Adam
 import pandas as pd
 import numpy as np
 import random
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
 import mlflow
 import pyarrow.parquet as pq
+from pyarrow import fs
 
 from pytorch_lightning.callbacks import (
     EarlyStopping,
@@ -23,12 +25,104 @@ from pytorch_lightning.callbacks import (
 )
 
 
-from config.preprocess import clean_text_feature
+from config.preprocess import CategoryEncoder, clean_text_feature
 from config.dataset import FastTextModelDataset
 from tokenizer.tokenizer import NGramTokenizer
 from models.model import FastTextModule, FastTextModel
 
 
+def split_train_val(
+    df: pd.DataFrame, train_proportion: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Split rows between training and validation sets from a hash of
+    their index, so that each row is assigned to the same set across
+    runs and cached tokenized corpora stay valid.
+
+    Args:
+        df (pd.DataFrame): Data.
+        train_proportion (float): Proportion of rows in the training set.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Positions of the training and
+            validation rows.
+    """
+    row_hash = pd.util.hash_pandas_object(df.index, index=False).to_numpy()
+    train_mask = row_hash % 100 < round(train_proportion * 100)
+    return np.flatnonzero(train_mask), np.flatnonzero(~train_mask)
+
+
+def tokenize_corpus_with_cache(
+    training_text: np.ndarray,
+    val_text: np.ndarray,
+    min_count: int,
+    min_n: int,
+    max_n: int,
+    buckets: int,
+    word_ngrams: int,
+    cache_dir: Path = Path(__file__).parent.parent / "data/cache",
+) -> Tuple[NGramTokenizer, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fit the tokenizer and tokenize the training and validation texts,
+    reusing the result cached on disk for the same texts and parameters.
+
+    Args:
+        training_text (np.ndarray): Training texts.
+        val_text (np.ndarray): Validation texts.
+        min_count (int): Minimum number of times a word has to be
+            in the training data to be given an embedding.
+        min_n (int): Minimum length of character n-grams.
+        max_n (int): Maximum length of character n-grams.
+        buckets (int): Number of rows in the embedding matrix.
+        word_ngrams (int): Maximum length of word n-grams.
+        cache_dir (Path, optional): Cache directory. Defaults to data/cache.
+
+    Returns:
+        Tuple[NGramTokenizer, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+            Tokenizer, training token indices and lengths, validation
+            token indices and lengths.
+    """
+    key = hashlib.blake2b(
+        f"{min_count}-{min_n}-{max_n}-{buckets}-{word_ngrams}-{len(training_text)}".encode()
+        + pd.util.hash_array(training_text).tobytes()
+        + pd.util.hash_array(val_text).tobytes(),
+        digest_size=16,
+    ).hexdigest()
+    corpus_path = cache_dir / f"{key}.npz"
+    tokenizer_path = cache_dir / f"{key}.pkl"
+
+    if corpus_path.exists() and tokenizer_path.exists():
+        with open(tokenizer_path, "rb") as file:
+            tokenizer = pickle.load(file)
+        corpus = np.load(corpus_path)
+        return (
+            tokenizer,
+            corpus["train_ids"],
+            corpus["train_lengths"],
+            corpus["val_ids"],
+            corpus["val_lengths"],
+        )
+
+    tokenizer = NGramTokenizer(
+        min_count, min_n, max_n, buckets, word_ngrams, training_text
+    )
+    train_ids, train_lengths = tokenizer.tokenize_corpus(training_text)
+    val_ids, val_lengths = tokenizer.tokenize_corpus(val_text)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    np.savez(
+        corpus_path,
+        train_ids=train_ids,
+        train_lengths=train_lengths,
+        val_ids=val_ids,
+        val_lengths=val_lengths,
+    )
+    with open(tokenizer_path, "wb") as file:
+        pickle.dump(tokenizer, file)
+
+    return tokenizer, train_ids, train_lengths, val_ids, val_lengths
+
+
 def train(
     df: pd.DataFrame,
     y: str,
@@ -59,52 +153,65 @@ def train(
     max_n = params["maxn"]
     word_ngrams = params["wordNgrams"]
     sparse = params["sparse"]
+    val_check_interval = params.get("val_check_interval", 1.0)
 
     # Train/val split
-    features = [text_feature]
-    if categorical_features is not None:
-        features += categorical_features
-    X_train, X_val, y_train, y_val = train_test_split(
-        df[features],
-        df[y],
-        test_size=1 - train_proportion,
-        random_state=0,
-        shuffle=True,
-    )
+    text_arr = df[text_feature].to_numpy()
+    cat_arr = df[categorical_features].to_numpy(dtype=np.int64, copy=False)
+    y_arr = df[y].to_numpy(np.int64)
 
-    training_text = X_train[text_feature].to_list()
-    tokenizer = NGramTokenizer(
-        min_count, min_n, max_n, buckets, word_ngrams, training_text
+    train_idx, val_idx = split_train_val(df, train_proportion)
+
+    cat_train, cat_val = cat_arr[train_idx], cat_arr[val_idx]
+
+    # Tokenize the whole corpus once
+    (
+        tokenizer,
+        train_ids,
+        train_lengths,
+        val_ids,
+        val_lengths,
+    ) = tokenize_corpus_with_cache(
+        text_arr[train_idx],
+        text_arr[val_idx],
+        min_count,
+        min_n,
+        max_n,
+        buckets,
+        word_ngrams,
     )
+    padding_idx = buckets + tokenizer.get_nwords()
 
     train_dataset = FastTextModelDataset(
-        categorical_variables=[
-            X_train[column].to_list() for column in X_train[categorical_features]
-        ],
-        texts=training_text,
-        outputs=y_train.to_list(),
-        tokenizer=tokenizer,
+        ids=train_ids,
+        lengths=train_lengths,
+        cat_matrix=cat_train,
+        y=y_arr[train_idx],
+        padding_idx=padding_idx,
     )
     val_dataset = FastTextModelDataset(
-        categorical_variables=[
-            X_val[column].to_list() for column in X_val[categorical_features]
-        ],
-        texts=X_val[text_feature].to_list(),
-        outputs=y_val.to_list(),
-        tokenizer=tokenizer,
+        ids=val_ids,
+        lengths=val_lengths,
+        cat_matrix=cat_val,
+        y=y_arr[val_idx],
+        padding_idx=padding_idx,
     )
+    dataloader_params = {
+        "num_workers": min(os.cpu_count() or 4, 8),
+        "persistent_workers": True,
+        "pin_memory": True,
+        "prefetch_factor": 2,
+    }
     train_dataloader = train_dataset.create_dataloader(
-        batch_size=batch_size, num_workers=72
+        batch_size=batch_size, shuffle=True, **dataloader_params
     )
     val_dataloader = val_dataset.create_dataloader(
-        batch_size=batch_size, num_workers=72
+        batch_size=batch_size, **dataloader_params
     )
 
     # Compute num_classes and categorical_vocabulary_sizes
     num_classes = df[y].nunique()
-    categorical_vocabulary_sizes = [
-        len(np.unique(X_train[feature])) for feature in categorical_features
-    ]
+    categorical_vocabulary_sizes = (cat_arr.max(axis=0) + 1).tolist()
     # Model
     model = FastTextModel(
         tokenizer=tokenizer,
@@ -113,15 +220,15 @@ def train(
         vocab_size=buckets + tokenizer.get_nwords() + 1,
         num_classes=num_classes,
         categorical_vocabulary_sizes=categorical_vocabulary_sizes,
-        padding_idx=buckets + tokenizer.get_nwords(),
+        padding_idx=padding_idx,
         sparse=sparse,
     )
+    if torch.cuda.is_available():
+        model.compile(mode="reduce-overhead", dynamic=True)
 
     # Define optimizer & scheduler
-    if sparse:
-        optimizer = SGD
-    else:
-        optimizer = Adam
+    # (sparse embeddings are handled by SparseAdam in FastTextModule)
+    optimizer = Adam
     optimizer_params = {"lr": lr}
     scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau
     scheduler_params = {
@@ -162,19 +269,27 @@ def train(
     # Strategy
     strategy = "auto"
 
+    # Mixed precision: bf16 on Ampere and newer GPUs, fp16 on older ones
+    if torch.cuda.is_available():
+        precision = "bf16-mixed" if torch.cuda.is_bf16_supported() else "16-mixed"
+    else:
+        precision = "32-true"
+
     # Trainer
     trainer = pl.Trainer(
         callbacks=callbacks,
         max_epochs=max_epochs,
-        num_sanity_val_steps=2,
+        val_check_interval=val_check_interval,
+        num_sanity_val_steps=0,
         strategy=strategy,
+        precision=precision,
         log_every_n_steps=2,
     )
 
     # Training
     mlflow.pytorch.autolog()
-    torch.cuda.empty_cache()
     torch.set_float32_matmul_precision("medium")
+    torch.backends.cudnn.benchmark = True
     trainer.fit(module, train_dataloader, val_dataloader)
 
     return trainer, module
@@ -189,15 +304,19 @@ if __name__ == "__main__":
     run_name = sys.argv[3]
 
     # Load data
-    fs = s3fs.S3FileSystem(
-        client_kwargs={"endpoint_url": "https://minio.lab.sspcloud.fr"}, anon=True
+    s3 = fs.S3FileSystem(
+        endpoint_override="https://minio.lab.sspcloud.fr",
+        anonymous=True,
+        request_timeout=30,
+        connect_timeout=5,
     )
     df = (
         pq.ParquetDataset(
             "projet-formation/diffusion/mlops/data/firm_activity_data.parquet",
-            filesystem=fs,
+            filesystem=s3,
+            pre_buffer=True,
         )
-        .read_pandas()
+        .read(columns=["text", "nace"], use_threads=True)
         .to_pandas()
     )
     # Subset of df to keep things short
@@ -207,7 +326,7 @@ if __name__ == "__main__":
     # Add fictitious additional variable
     df["additional_var"] = np.random.randint(0, 2, df.shape[0])
     # Encode classes
-    encoder = LabelEncoder()
+    encoder = CategoryEncoder()
     df["nace"] = encoder.fit_transform(df["nace"])
 
     # Start MLflow run
@@ -231,21 +350,19 @@ if __name__ == "__main__":
                 "minn": 3,
                 "maxn": 6,
                 "wordNgrams": 3,
-                "sparse": False,
+                "sparse": True,
+                "val_check_interval": 1.0,
             },
         )
-        best_model = type(light_module).load_from_checkpoint(
-            checkpoint_path=trainer.checkpoint_callback.best_model_path,
-            model=light_module.model,
-            loss=light_module.loss,
-            optimizer=light_module.optimizer,
-            optimizer_params=light_module.optimizer_params,
-            scheduler=light_module.scheduler,
-            scheduler_params=light_module.scheduler_params,
-            scheduler_interval=light_module.scheduler_interval,
+        # Reload the best weights in place, optimizer states are not read
+        checkpoint = torch.load(
+            trainer.checkpoint_callback.best_model_path, map_location="cpu", mmap=True
         )
+        light_module.load_state_dict(checkpoint["state_dict"])
+        del checkpoint
+        best_model = light_module.to("cpu")
         mlflow.pytorch.log_model(
             artifact_path="model",
             code_paths=["src/models/", "src/config/",  "src/explainability/", "src/tokenizer/"],
-            pytorch_model=best_model.to("cpu")
+            pytorch_model=best_model
         )